@@ -1,18 +1,64 @@
+import asyncio
 import subprocess
-import threading
 import signal
 import os
+import stat
+import threading
 import json
+import re
+from contextlib import asynccontextmanager
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from pathlib import Path
 
+import anyio
+import anyio.to_thread
 from fastapi import FastAPI, Form, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+try:
+    import orjson
+except ImportError:  # optional C-accelerated JSON; stdlib json is the fallback
+    orjson = None
+
+# Long-running blocking work gets its own thread budgets so it can't starve the default
+# threadpool that StaticFiles uses for download stats and reads
+CLIP_LIMITER = anyio.CapacityLimiter(4)  # each ffmpeg clip can hold a token for FFMPEG_TIMEOUT
+SCAN_LIMITER = anyio.CapacityLimiter(2)  # directory scans, which may spawn yt-dlp title lookups
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await anyio.to_thread.run_sync(_load_title_cache, limiter=SCAN_LIMITER)
+    yield
+    await _stop_all_recordings()
+
+
+async def _stop_all_recordings():
+    # yt-dlp runs in its own session, so the server's Ctrl+C no longer reaches it. Stop every
+    # recording the way stop_recording does and give yt-dlp time to finalize its output.
+    pending = []
+    for rec in list(active_processes.values()):
+        if rec["proc"] is None:
+            continue
+        try:
+            os.killpg(rec["proc"].pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        pending.append(rec["done"].wait())
+    if not pending:
+        return
+    try:
+        await asyncio.wait_for(asyncio.gather(*pending), timeout=SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"❌ Recordings still finalizing after {SHUTDOWN_TIMEOUT}s, shutting down anyway")
 
-app = FastAPI(title="YouTube Live Recorder")
+
+app = FastAPI(title="YouTube Live Recorder", lifespan=lifespan)
 
 DOWNLOAD_DIR = Path("downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
@@ -20,18 +66,68 @@ DOWNLOAD_DIR.mkdir(exist_ok=True)
 METADATA_DIR = DOWNLOAD_DIR / "_metadata"
 METADATA_DIR.mkdir(exist_ok=True)
 
+# Serves recording downloads (with range requests); there is no separate download route
 app.mount("/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
 
-templates = Jinja2Templates(directory="templates")
+JINJA_CACHE_DIR = Path(".jinja_cache")
+JINJA_CACHE_DIR.mkdir(exist_ok=True)
+
+# Templates only change on deploy: skip the per-render stat (auto_reload) and reuse compiled bytecode
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    autoescape=True,
+    auto_reload=False,
+    bytecode_cache=FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+))
 
+# video_id -> {"proc", "path", "done": asyncio.Event set once yt-dlp exits}; start_recording reserves
+# the slot with proc/path None and the supervisor fills them in once yt-dlp is running
 active_processes = {}
+background_tasks = set()  # strong refs so recorder tasks aren't garbage-collected mid-run
+IST = ZoneInfo("Asia/Kolkata")
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"  # recording filenames sort chronologically by this
 FFMPEG_PATH = "ffmpeg"  # should be available on Railway after adding RAILPACK_DEPLOY_APT_PACKAGES=ffmpeg
+FFMPEG_TIMEOUT = 600  # seconds
+SHUTDOWN_TIMEOUT = 60  # seconds yt-dlp gets to finalize recordings when the server stops
+
+# Rendered recording list, reused until either directory's mtime or the generation changes;
+# the generation is bumped whenever a recording ends
+_home_cache = {"key": None, "generation": 0, "data": None, "lock": asyncio.Lock()}
+
+
+# video_id -> (title file mtime_ns, title); preloaded at startup, read from worker threads
+_title_cache = {}
+_title_cache_lock = threading.Lock()
+
+
+def _read_title(video_id: str, title_file: Path, mtime_ns: int) -> str:
+    title = title_file.read_text(encoding="utf-8").strip() or video_id
+    with _title_cache_lock:
+        _title_cache[video_id] = (mtime_ns, title)
+    return title
+
+
+def _load_title_cache():
+    with os.scandir(METADATA_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".title.txt"):
+                video_id = entry.name[:-len(".title.txt")]
+                _read_title(video_id, Path(entry.path), entry.stat().st_mtime_ns)
 
 
 def get_video_title(video_id: str) -> str:
     title_file = METADATA_DIR / f"{video_id}.title.txt"
-    if title_file.exists():
-        return title_file.read_text(encoding="utf-8").strip() or video_id
+    try:
+        mtime_ns = title_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = None
+
+    if mtime_ns is not None:
+        with _title_cache_lock:
+            cached = _title_cache.get(video_id)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        return _read_title(video_id, title_file, mtime_ns)
 
     try:
         result = subprocess.run(
@@ -43,6 +139,8 @@ def get_video_title(video_id: str) -> str:
         if result.returncode == 0:
             title = result.stdout.strip() or video_id
             title_file.write_text(title, encoding="utf-8")
+            with _title_cache_lock:
+                _title_cache[video_id] = (title_file.stat().st_mtime_ns, title)
             return title
     except Exception:
         pass
@@ -50,53 +148,90 @@ def get_video_title(video_id: str) -> str:
     return video_id
 
 
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+
+def _read_tail(path: Path, size: int = 4096) -> str:
+    with open(path, "rb") as f:
+        f.seek(max(f.seek(0, os.SEEK_END) - size, 0))
+        return f.read().decode("utf-8", errors="ignore")
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+# [[h:]m:]s, where only the seconds field may be fractional
+_TIME_RE = re.compile(r"^\s*(?:(?:(\d+):)?(\d+):)?([\d.]+)\s*$")
+
+
 def parse_time_to_seconds(time_str: str) -> float | None:
-    if not time_str or not time_str.strip():
+    m = _TIME_RE.match(time_str or "")
+    if not m:
         return None
-    time_str = time_str.strip()
+    h, mn, sec = m.groups()
     try:
-        if ':' in time_str:
-            parts = time_str.split(':')
-            if len(parts) == 2:
-                m, s = map(float, parts)
-                return m * 60 + s
-            elif len(parts) == 3:
-                h, m, s = map(float, parts)
-                return h * 3600 + m * 60 + s
-        return float(time_str)
-    except:
+        return int(h or 0) * 3600 + int(mn or 0) * 60 + float(sec)
+    except ValueError:  # e.g. "1.2.3"
         return None
 
 
-def record_live_stream(video_id: str):
+async def record_live_stream(video_id: str, recording: dict):
     url = f"https://www.youtube.com/watch?v={video_id}"
-    ist_time = datetime.now(ZoneInfo("Asia/Kolkata"))
-    timestamp = ist_time.strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now(IST).strftime(TIMESTAMP_FORMAT)
     output_filename = f"{video_id}_{timestamp}.mp4"
     output_path = DOWNLOAD_DIR / output_filename
+    log_path = METADATA_DIR / f"{video_id}_{timestamp}.log"
 
     print(f"🎥 Started: {url} → {output_path}")
 
     cmd = [
         "yt-dlp",
         "--live-from-start",
-        "-f", "bv*+ba/best",
+        # A combined mp4 needs no post-recording merge pass, but only take one that is at least
+        # 720p; YouTube's usual combined format is 360p, and live DASH formats always need the merge
+        "-f", "best[ext=mp4][height>=720]/bv*+ba/best",
         "-o", str(output_path),
         "--merge-output-format", "mp4",
+        "--no-part",
+        "--no-progress",  # progress lines would fill the per-recording log for the whole stream
+        "--concurrent-fragments", "4",
         url
     ]
 
     try:
-        process = subprocess.Popen(cmd)
-        active_processes[video_id] = (process, str(output_path))
-        process.wait()
-        if video_id in active_processes:
-            del active_processes[video_id]
+        # yt-dlp output goes to a per-recording log rather than the server's stdout, and the
+        # new session lets stop_recording signal yt-dlp together with its ffmpeg children
+        with open(log_path, "wb") as log_file:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=log_file,
+                start_new_session=True,
+            )
+        recording["proc"], recording["path"] = process, str(output_path)
+        await process.wait()
         print(f"✅ Done: {output_path}")
     except Exception as e:
         print(f"❌ Error: {e}")
-        if video_id in active_processes:
+    finally:
+        # Only remove our own entry, never a newer recording registered under the same id
+        if active_processes.get(video_id) is recording:
             del active_processes[video_id]
+        # The output grew in place without bumping the directory mtime, so drop the last scan
+        _home_cache["generation"] += 1
+        recording["done"].set()
 
 
 def create_clip(input_path: str, start_time: str, end_time: str = "") -> tuple[bool, str]:
@@ -105,18 +240,24 @@ def create_clip(input_path: str, start_time: str, end_time: str = "") -> tuple[b
         return False, "Invalid start time"
 
     input_path_obj = Path(input_path)
-    video_id = input_path_obj.stem.split('_')[0]
+    video_id = input_path_obj.stem.partition('_')[0]
     start_str = start_time.replace(':', '').replace(' ', '')
     end_str = end_time.replace(':', '').replace(' ', '') if end_time else 'end'
     clip_filename = f"{video_id}_{start_str}-{end_str}.mp4"
     clip_path = input_path_obj.parent / clip_filename
+    # ffmpeg writes under a "_" name, which the listing skips, and the clip is moved into place only
+    # on success, so a failed or timed-out mux (no moov atom with +faststart) never shows up as a recording
+    tmp_path = clip_path.with_name(f"_{clip_filename}")
 
+    # -ss before -i seeks the input by keyframe index instead of decoding up to the cut point
     cmd = [
         FFMPEG_PATH,
-        "-i", input_path,
+        "-nostdin",
         "-ss", str(start_sec),
+        "-i", input_path,
         "-c", "copy",
         "-avoid_negative_ts", "make_zero",
+        "-movflags", "+faststart",
     ]
 
     if end_time:
@@ -126,52 +267,96 @@ def create_clip(input_path: str, start_time: str, end_time: str = "") -> tuple[b
         duration = end_sec - start_sec
         cmd.extend(["-t", str(duration)])
 
-    cmd.append(str(clip_path))
+    cmd.extend(["-y", str(tmp_path)])  # -y: a leftover temp file from a crash may exist
 
+    # ffmpeg's stderr can be huge on long inputs, so stream it to a log and only read the tail on failure
+    log_path = METADATA_DIR / f"{clip_filename}.ffmpeg.log"
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0 and clip_path.exists() and clip_path.stat().st_size > 1000:
+        with open(log_path, "wb") as log_file:
+            result = subprocess.run(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log_file, timeout=FFMPEG_TIMEOUT
+            )
+        if result.returncode == 0 and _file_size(tmp_path) > 1000:
+            os.replace(tmp_path, clip_path)
+
             # Save trim metadata
             trim_data = {"start": start_time}
             if end_time:
                 trim_data["end"] = end_time
             trim_file = METADATA_DIR / f"{clip_filename}.trim.json"
-            trim_file.write_text(json.dumps(trim_data, indent=2), encoding="utf-8")
+            trim_file.write_bytes(_json_dumps(trim_data))
 
             return True, f"Clip saved as: {clip_filename}"
-        else:
-            return False, f"ffmpeg error: {result.stderr.strip() or 'unknown'}"
+        error = f"ffmpeg error: {_read_tail(log_path).strip() or 'unknown'}"
     except Exception as e:
-        return False, f"Failed to run ffmpeg: {str(e)}"
+        error = f"Failed to run ffmpeg: {str(e)}"
+    finally:
+        log_path.unlink(missing_ok=True)
 
+    tmp_path.unlink(missing_ok=True)
+    return False, error
 
-@app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
+
+# Only touched from _scan_recordings, which the home cache lock already serialises
+_trim_index = {"mtime": None, "entries": {}}  # clip filename -> (trim file mtime_ns, path)
+_trim_parsed = {}  # clip filename -> (trim file mtime_ns, formatted trim info)
+
+
+def _load_trim_index() -> dict:
+    dir_mtime = METADATA_DIR.stat().st_mtime_ns
+    if dir_mtime != _trim_index["mtime"]:
+        entries = {}
+        with os.scandir(METADATA_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".trim.json"):
+                    entries[entry.name[:-len(".trim.json")]] = (entry.stat().st_mtime_ns, entry.path)
+        _trim_index["mtime"], _trim_index["entries"] = dir_mtime, entries
+    return _trim_index["entries"]
+
+
+def _trim_info(filename: str, trim_index: dict) -> str:
+    hit = trim_index.get(filename)
+    if hit is None:
+        return "-"
+
+    mtime_ns, path = hit
+    cached = _trim_parsed.get(filename)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    trim_info = "-"
+    try:
+        with open(path, "rb") as f:
+            data = _json_loads(f.read())
+        s = data.get("start", "")
+        e = data.get("end", "")
+        trim_info = f"{s} → {e}" if e else f"{s} → end"
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    _trim_parsed[filename] = (mtime_ns, trim_info)
+    return trim_info
+
+
+def _scan_recordings() -> list[dict]:
     recordings = []
+    trim_index = _load_trim_index()
 
-    for file in DOWNLOAD_DIR.glob("*.mp4"):
-        if file.name.startswith("_"):  # skip metadata files if any leak here
-            continue
+    with os.scandir(DOWNLOAD_DIR) as it:
+        # skip metadata files if any leak here
+        entries = {e.name: e for e in it if not e.name.startswith("_") and e.name.endswith(".mp4")}
 
-        filename = file.name
-        parts = filename.split("_", 1)
-        video_id = parts[0] if len(parts) > 1 else "unknown"
+    # Names are <video_id>_<timestamp>.mp4, so a plain string sort (no key function) orders them
+    for filename in sorted(entries, reverse=True):
+        idx = filename.find("_")
+        video_id = filename[:idx] if idx > 0 else "unknown"
 
         title = get_video_title(video_id)
 
-        # Read trim info
-        trim_info = "-"
-        trim_file = METADATA_DIR / f"{filename}.trim.json"
-        if trim_file.exists():
-            try:
-                data = json.loads(trim_file.read_text(encoding="utf-8"))
-                s = data.get("start", "")
-                e = data.get("end", "")
-                trim_info = f"{s} → {e}" if e else f"{s} → end"
-            except:
-                pass
+        trim_info = _trim_info(filename, trim_index)
 
-        size_mb = round(file.stat().st_size / (1024**2), 2) if file.stat().st_size > 0 else 0
+        size = entries[filename].stat().st_size
+        size_mb = round(size / (1024**2), 2) if size > 0 else 0
 
         recordings.append({
             "filename": filename,
@@ -182,20 +367,62 @@ async def home(request: Request):
             "url": f"/downloads/{filename}"
         })
 
+    return recordings
+
+
+async def _get_recordings() -> list[dict]:
+    async with _home_cache["lock"]:
+        # New clips, deletes, titles and trim files all touch one of these two directories.
+        # Files being recorded grow without bumping either, so always rescan while recording.
+        # The key is taken before scanning, so a recording that ends mid-scan leaves it stale.
+        key = (DOWNLOAD_DIR.stat().st_mtime_ns, METADATA_DIR.stat().st_mtime_ns, _home_cache["generation"])
+        if active_processes or key != _home_cache["key"]:
+            # Directory scan, title lookups and metadata reads all block, so keep them off the event loop
+            _home_cache["data"] = await anyio.to_thread.run_sync(_scan_recordings, limiter=SCAN_LIMITER)
+            _home_cache["key"] = key
+        return _home_cache["data"]
+
+
+def _recording_path(filename: str) -> Path:
+    # One stat covers both the existence and the regular-file check
+    file_path = DOWNLOAD_DIR / filename
+    try:
+        st = os.stat(file_path)
+    except (OSError, ValueError):  # missing, a path through a file, symlink loop, NUL byte...
+        raise HTTPException(404, "File not found")
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(404, "File not found")
+    return file_path
+
+
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request):
     active = []
-    for vid, (proc, out) in active_processes.items():
+    in_progress = []
+    # The supervisor deregisters itself as soon as yt-dlp exits, and nothing awaits in this loop
+    for vid, rec in active_processes.items():
+        if rec["path"] is None:  # reserved, yt-dlp not spawned yet
+            active.append({"video_id": vid, "output": "(starting)", "pid": None})
+            continue
         active.append({
             "video_id": vid,
-            "output": os.path.basename(out),
-            "pid": proc.pid
+            "output": os.path.basename(rec["path"]),
+            "pid": rec["proc"].pid
         })
+        in_progress.append(Path(rec["path"]).stem + ".")
+
+    recordings = await _get_recordings()
+    if in_progress:
+        # With --no-part the output (or, on the bv*+ba fallback, its <stem>.f<NNN>.mp4 format
+        # files) exists while it is still being written
+        recordings = [rec for rec in recordings if not rec["filename"].startswith(tuple(in_progress))]
 
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,
             "active_recordings": active,
-            "completed_recordings": sorted(recordings, key=lambda x: x["filename"], reverse=True)
+            "completed_recordings": recordings
         }
     )
 
@@ -208,8 +435,12 @@ async def start_recording(video_id: str = Form(...)):
     if video_id in active_processes:
         return RedirectResponse(url="/", status_code=303)
 
-    thread = threading.Thread(target=record_live_stream, args=(video_id,), daemon=True)
-    thread.start()
+    # Reserve the slot before yielding to the loop so a double submit can't start a second yt-dlp
+    recording = {"proc": None, "path": None, "done": asyncio.Event()}
+    active_processes[video_id] = recording
+    task = asyncio.create_task(record_live_stream(video_id, recording))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
     return RedirectResponse(url="/", status_code=303)
 
 
@@ -217,8 +448,13 @@ async def start_recording(video_id: str = Form(...)):
 async def stop_recording(video_id: str = Form(...)):
     if video_id not in active_processes:
         raise HTTPException(400, "No active recording")
-    process, _ = active_processes[video_id]
-    process.send_signal(signal.SIGINT)
+    process = active_processes[video_id]["proc"]
+    if process is None:
+        raise HTTPException(409, "Recording is still starting")
+    try:
+        os.killpg(process.pid, signal.SIGINT)
+    except ProcessLookupError:  # already exited; the supervisor will clean up
+        pass
     return RedirectResponse(url="/", status_code=303)
 
 
@@ -228,11 +464,22 @@ async def trim_recording(
     start_time: str = Form(...),
     end_time: str = Form(default="")
 ):
-    file_path = DOWNLOAD_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(404, "File not found")
+    # A just-stopped recording may still be muxing; stream-copying it now would read a partial file
+    recording = next(
+        (r for r in active_processes.values() if r["path"] and os.path.basename(r["path"]) == filename),
+        None,
+    )
+    if recording:
+        try:
+            await asyncio.wait_for(recording["done"].wait(), timeout=30)
+        except asyncio.TimeoutError:
+            raise HTTPException(409, "Recording still in progress")
 
-    success, message = create_clip(str(file_path), start_time, end_time)
+    file_path = _recording_path(filename)
+
+    success, message = await anyio.to_thread.run_sync(
+        create_clip, str(file_path), start_time, end_time, limiter=CLIP_LIMITER
+    )
     if not success:
         raise HTTPException(500, message)
 
@@ -242,35 +489,26 @@ async def trim_recording(
 @app.post("/delete-recording")
 async def delete_recording(filename: str = Form(...)):
     file_path = DOWNLOAD_DIR / filename
-    if not file_path.exists():
+    try:
+        await run_in_threadpool(file_path.unlink)
+    except (OSError, ValueError):  # missing, a directory, a path through a file, NUL byte... (as _recording_path)
         raise HTTPException(404, "File not found")
 
     # Also clean up metadata if exists
-    (METADATA_DIR / f"{filename}.trim.json").unlink(missing_ok=True)
-
-    file_path.unlink()
+    await run_in_threadpool((METADATA_DIR / f"{filename}.trim.json").unlink, missing_ok=True)
+    await run_in_threadpool((METADATA_DIR / f"{Path(filename).stem}.log").unlink, missing_ok=True)
     return RedirectResponse(url="/", status_code=303)
 
 
 @app.get("/trim-form", response_class=HTMLResponse)
 async def trim_form(request: Request, filename: str):
-    file_path = DOWNLOAD_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(404, "File not found")
+    _recording_path(filename)
     return templates.TemplateResponse("trim-form.html", {
         "request": request,
         "filename": filename
     })
 
 
-@app.get("/downloads/{filename}")
-async def get_file(filename: str):
-    file_path = DOWNLOAD_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(404, "File not found")
-    return FileResponse(file_path, filename=filename)
-
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file